@@ -27,7 +27,6 @@ class DataConfig:
     # Data loading
     num_workers: int = 4
     pin_memory: bool = True
-    prefetch_factor: int = 2
     
     # Paths
     data_dir: str = "./data"
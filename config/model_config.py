@@ -14,4 +14,6 @@ class ModelConfig:
     
     # Other params
     label_smoothing: float = 0.1
-    tie_weights: bool = True
\ No newline at end of file
+    tie_weights: bool = True
+    compile_encoder: bool = False # torch.compile the encoder stack
+    ffn_bf16: bool = False # run the encoder FFN under BF16 autocast on CUDA
\ No newline at end of file
@@ -1,5 +1,6 @@
 # config/training_config.py
 from dataclasses import dataclass
+from typing import Optional
 
 @dataclass
 class TrainingConfig:
@@ -31,4 +32,8 @@ class TrainingConfig:
     # Device
     device: str = "cuda"
     mixed_precision: bool = True
-    compile_model: bool = False
\ No newline at end of file
+    compile_model: bool = False
+
+    # Data loading
+    prefetch_factor: int = 4 # batches prefetched per DataLoader worker
+    tokenize_num_proc: Optional[int] = None # processes for the one-time tokenization of the train split
\ No newline at end of file
@@ -4,6 +4,11 @@ import torch.nn.functional as F
 import math
 import sys
 
+try:
+    from flash_attn import flash_attn_varlen_qkvpacked_func
+except ImportError:
+    flash_attn_varlen_qkvpacked_func = None
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, d_model, n_heads, dropout=0.1):
         super().__init__()
@@ -32,7 +37,8 @@ class MultiHeadAttention(nn.Module):
         # Compute attention scores
         scores = torch.matmul(Q, K.transpose(-2, -1)) / self.scale
 
-        if torch.isnan(scores).any() or torch.isinf(scores).any():
+        # Eager-only check: under torch.compile this branch would break the graph
+        if not torch.compiler.is_compiling() and (torch.isnan(scores).any() or torch.isinf(scores).any()):
             print(f"\n[ERROR] NaN/Inf detected in attention scores BEFORE softmax!", file=sys.stderr)
             print(f"  Scores min: {scores.min().item():.4f}, max: {scores.max().item():.4f}", file=sys.stderr)
             print(f"  Scores mean: {scores.mean().item():.4f}, std: {scores.std().item():.4f}", file=sys.stderr)
@@ -63,4 +69,19 @@ class MultiHeadAttention(nn.Module):
         
         # Concatenate heads and put through final linear layer
         output = output.transpose(1, 2).contiguous().view(batch_size, query.size(1), self.d_model)
-        return self.w_o(output)
\ No newline at end of file
+        return self.w_o(output)
+
+    def forward_varlen(self, x, cu_seqlens, max_seqlen):
+        # x is packed as (total_tokens, d_model); cu_seqlens holds the sequence boundaries
+        total_tokens = x.size(0)
+        qkv = torch.stack([self.w_q(x), self.w_k(x), self.w_v(x)], dim=1)
+        qkv = qkv.view(total_tokens, 3, self.n_heads, self.d_k)
+
+        output = flash_attn_varlen_qkvpacked_func(
+            qkv,
+            cu_seqlens,
+            max_seqlen,
+            dropout_p=self.dropout.p if self.training else 0.0,
+            softmax_scale=1.0 / self.scale
+        )
+        return self.w_o(output.reshape(total_tokens, self.d_model))
\ No newline at end of file
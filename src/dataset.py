@@ -1,123 +1,266 @@
 import os
+import math
+import hashlib
+import shutil
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torch.utils.data.distributed import DistributedSampler 
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk, Features, Sequence, Value
 from transformers import PreTrainedTokenizerFast
-from torch.nn.utils.rnn import pad_sequence
 from functools import partial
-from datasets import load_dataset
+
+# The batched Rust tokenizer call parallelizes over each batch internally
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
 
 class TranslationDataset(Dataset):
-    def __init__(self, data, tokenizer, max_length=512, lang_keys=('en', 'de')):
-        self.data = data
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-        self.lang_keys = lang_keys
+    def __init__(self, data):
+        # Index the memory-mapped Arrow table directly; the torch format hands back
+        # int32 tensors without any Python-level conversion in __getitem__
+        self.data = data.with_format('torch', columns=['src_ids', 'tgt_ids'], dtype=torch.int32)
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
         item = self.data[idx]
-        if 'translation' in item:
-            src_text = item['translation'][self.lang_keys[0]]
-            tgt_text = item['translation'][self.lang_keys[1]]
-        else:
-            src_text = item[self.lang_keys[0]]
-            tgt_text = item[self.lang_keys[1]]
-
-        src_encoding = self.tokenizer.encode(
-            src_text, 
-            add_special_tokens=False,
-            max_length=self.max_length - 2,
-            truncation=True
-        )
-        tgt_encoding = self.tokenizer.encode(
-            tgt_text,
-            add_special_tokens=False,
-            max_length=self.max_length - 2,
-            truncation=True
-        )
+        return item['src_ids'], item['tgt_ids']
+
+def get_texts(batch, lang_keys=('en', 'de')):
+    if 'translation' in batch:
+        src_texts = [pair[lang_keys[0]] for pair in batch['translation']]
+        tgt_texts = [pair[lang_keys[1]] for pair in batch['translation']]
+    else:
+        src_texts = batch[lang_keys[0]]
+        tgt_texts = batch[lang_keys[1]]
+    return src_texts, tgt_texts
+
+def tokenize_batch(batch, tokenizer, max_length, lang_keys=('en', 'de')):
+    src_texts, tgt_texts = get_texts(batch, lang_keys)
+
+    bos_id = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else 1
+    eos_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 2
+
+    # One batched call into the Rust tokenizer instead of one per sentence. Going through
+    # __call__ rather than the raw backend turns off the padding that train_tokenizer.py
+    # saves into the tokenizer file, so every sentence keeps its own length.
+    src_encodings = tokenizer(src_texts, add_special_tokens=False)['input_ids']
+    tgt_encodings = tokenizer(tgt_texts, add_special_tokens=False)['input_ids']
 
-        if isinstance(src_encoding, list):
-            src_token_ids = src_encoding
-            tgt_token_ids = tgt_encoding
+    src_ids = [[bos_id] + ids[:max_length - 2] + [eos_id] for ids in src_encodings]
+    tgt_ids = [[bos_id] + ids[:max_length - 2] + [eos_id] for ids in tgt_encodings]
+    return {
+        'src_ids': src_ids,
+        'src_len': [len(ids) for ids in src_ids],
+        'tgt_ids': tgt_ids,
+        'tgt_len': [len(ids) for ids in tgt_ids]
+    }
+
+# Lengths are stored next to the ids so samplers read one contiguous int32 column
+TOKENIZED_FEATURES = Features({
+    'src_ids': Sequence(Value('int32')),
+    'src_len': Value('int32'),
+    'tgt_ids': Sequence(Value('int32')),
+    'tgt_len': Value('int32')
+})
+
+def tokenize_dataset(data, tokenizer, max_length, lang_keys=('en', 'de'), num_proc=None):
+    """Tokenizes every sample once up front so __getitem__ only slices Arrow memory."""
+    data = data.map(
+        partial(tokenize_batch, tokenizer=tokenizer, max_length=max_length, lang_keys=lang_keys),
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc,
+        remove_columns=data.column_names,
+        features=TOKENIZED_FEATURES
+    )
+    return data
+
+class BucketBatchSampler(Sampler):
+    """Groups samples of similar source length into the same batch to minimise padding."""
+    def __init__(self, lengths, batch_size, bucket_width=8, shuffle=True,
+                 num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_batches(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        # Same seed on every rank, so all replicas agree on the batch layout.
+        # Like DistributedSampler, call set_epoch() each epoch to get a new order.
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            buckets = self.lengths[order] // self.bucket_width
+            order = order[np.argsort(buckets, kind='stable')]
         else:
-            src_token_ids = src_encoding.ids
-            tgt_token_ids = tgt_encoding.ids
+            order = np.argsort(self.lengths, kind='stable')
 
-        bos_id = self.tokenizer.bos_token_id if self.tokenizer.bos_token_id is not None else 1
-        eos_id = self.tokenizer.eos_token_id if self.tokenizer.eos_token_id is not None else 2
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
 
-        src_final_tokens = [bos_id] + src_token_ids + [eos_id]
-        tgt_final_tokens = [bos_id] + tgt_token_ids + [eos_id]
-        
-        return {
-            'src': torch.tensor(src_final_tokens, dtype=torch.long),
-            'tgt': torch.tensor(tgt_final_tokens, dtype=torch.long)
-        }
+        # Every rank must run the same number of steps per epoch
+        num_local = len(self)
+        for batch in batches[self.rank:num_local * self.num_replicas:self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self._num_batches() // self.num_replicas
+
+class CUDAPrefetcher:
+    """Wraps a DataLoader so the next batch's H2D copy overlaps with the current step."""
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device if device is not None else torch.device('cuda', torch.cuda.current_device())
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Expose sampler, batch_sampler, dataset, ... of the wrapped loader
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return {key: value.to(self.device, non_blocking=True) for key, value in batch.items()}
+
+        next_batch = preload()
+        while next_batch is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_stream(stream)
+            batch = next_batch
+            for tensor in batch.values():
+                # The copies were allocated on the side stream but are consumed on the compute stream
+                tensor.record_stream(compute_stream)
+            next_batch = preload()
+            yield batch
+
+def pin_worker_to_core(worker_id, rank=0, num_workers=1):
+    # Give every worker of every rank its own core so its memory stays on the local NUMA node
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cores[(rank * num_workers + worker_id) % len(cores)]})
+
+def pad_batch(sequences, pad_token_id):
+    lengths = [len(seq) for seq in sequences]
+    max_len = max(lengths)
+    if min(lengths) == max_len:
+        return torch.stack(sequences)
+
+    # int32 ids halve the bytes moved through workers, pinning and the H2D copy
+    padded = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.int32)
+    padded_np = padded.numpy()
+    for i, seq in enumerate(sequences):
+        padded_np[i, :lengths[i]] = seq.numpy()  # memcpy into the preallocated buffer
+    return padded
 
 def collate_fn(batch, pad_token_id):
-    src_batch, tgt_batch = [], []
-    for item in batch:
-        src_batch.append(item['src'])
-        tgt_batch.append(item['tgt'])
-    
-    src_batch = pad_sequence(src_batch, batch_first=True, padding_value=pad_token_id)
-    tgt_batch = pad_sequence(tgt_batch, batch_first=True, padding_value=pad_token_id)
+    src_list, tgt_list = zip(*batch)
+    src_batch = pad_batch(src_list, pad_token_id)
+    tgt_batch = pad_batch(tgt_list, pad_token_id)
     
     return {'src': src_batch, 'tgt': tgt_batch}
 
-def check_and_remove_leakage(train_data, val_data, rank=0):
+def pair_keys(batch, lang_keys=('en', 'de')):
+    src_texts, tgt_texts = get_texts(batch, lang_keys)
+    # NOTE: use string for uniqueness
+    return [f"{en.strip().lower()}||{de.strip().lower()}" for en, de in zip(src_texts, tgt_texts)]
+
+def check_and_remove_leakage(train_data, val_data, rank=0, lang_keys=('en', 'de')):
+    keep_indices = None
     if rank == 0:
         print("\n--- PERFORMING COMPREHENSIVE LEAKAGE CHECK ---")
-        
-        train_pairs = set()
-        for sample in train_data:
-            if 'translation' in sample:
-                en_text = sample['translation']['en'].strip().lower()
-                de_text = sample['translation']['de'].strip().lower()
-            else:
-                en_text = sample['en'].strip().lower()
-                de_text = sample['de'].strip().lower()
-            train_pairs.add(f"{en_text}||{de_text}")  # NOTE: use string for uniqueness
+
+        # Fetch the text columns in one go instead of materialising every row as a dict
+        text_columns = ['translation'] if 'translation' in train_data.column_names else list(lang_keys)
+        train_pairs = set(pair_keys(train_data.select_columns(text_columns)[:], lang_keys))
         
         print(f"[Leakage Check] Training set has {len(train_pairs)} unique translation pairs.")
-        
-        leaked_indices = []
-        for idx, sample in enumerate(val_data):
-            if 'translation' in sample:
-                en_text = sample['translation']['en'].strip().lower()
-                de_text = sample['translation']['de'].strip().lower()
-            else:
-                en_text = sample['en'].strip().lower()
-                de_text = sample['de'].strip().lower()
-            key = f"{en_text}||{de_text}"
-            if key in train_pairs:
-                leaked_indices.append(idx)
-
-        if len(leaked_indices) > 0:
-            print(f"\n!!! LEAKAGE DETECTED: {len(leaked_indices)} validation samples overlap with train set !!!")
+
+        indexed_val = val_data.select_columns(text_columns).add_column('row_idx', list(range(len(val_data))))
+        kept = indexed_val.filter(
+            lambda batch: [key not in train_pairs for key in pair_keys(batch, lang_keys)],
+            batched=True,
+            batch_size=1000,
+            num_proc=min(8, os.cpu_count() or 1)
+        )
+        keep_indices = list(kept['row_idx'])
+        num_leaked = len(val_data) - len(keep_indices)
+
+        if num_leaked > 0:
+            print(f"\n!!! LEAKAGE DETECTED: {num_leaked} validation samples overlap with train set !!!")
             print("Removing leaked samples from validation set...")
-            val_data_list = [sample for idx, sample in enumerate(val_data) if idx not in set(leaked_indices)]
-            print(f"Validation set: {len(val_data)} --> {len(val_data_list)} after removal.")
+            print(f"Validation set: {len(val_data)} --> {len(keep_indices)} after removal.")
             print("[Leakage Check] First 3 overlaps:")
-            for i in leaked_indices[:3]:
-                if 'translation' in val_data[i]:
-                    print('SRC:', val_data[i]['translation']['en'])
-                    print('TGT:', val_data[i]['translation']['de'])
-                else:
-                    print('SRC:', val_data[i]['en'])
-                    print('TGT:', val_data[i]['de'])
+            kept_set = set(keep_indices)
+            leaked_indices = [idx for idx in range(len(val_data)) if idx not in kept_set][:3]
+            src_texts, tgt_texts = get_texts(val_data.select(leaked_indices)[:], lang_keys)
+            for src_text, tgt_text in zip(src_texts, tgt_texts):
+                print('SRC:', src_text)
+                print('TGT:', tgt_text)
         else:
             print(" No train/val overlaps detected.")
-            val_data_list = list(val_data)
-        return val_data_list
-    else:
-        return list(val_data)
+
+    # Only rank 0 runs the check; the other ranks receive its result instead of re-filtering
+    if dist.is_available() and dist.is_initialized():
+        payload = [keep_indices]
+        dist.broadcast_object_list(payload, src=0)
+        keep_indices = payload[0]
+    elif keep_indices is None:
+        return val_data
+
+    if len(keep_indices) == len(val_data):
+        return val_data
+    return val_data.select(keep_indices)
 
 
+# Bump whenever tokenize_batch changes what it writes, so caches from older code miss.
+# 2: ids no longer carry the padding saved in the tokenizer file
+TOKENIZATION_VERSION = 2
+
+def tokenized_cache_key(tokenizer_path, dataset_name, max_length, subset_size, seed):
+    # Changes whenever the tokenizer file or anything that shapes the tokenized splits changes
+    with open(tokenizer_path, 'rb') as f:
+        tokenizer_bytes = f.read()
+    columns = ",".join(TOKENIZED_FEATURES)
+    settings = f"v{TOKENIZATION_VERSION}|{dataset_name}|{max_length}|{subset_size}|{seed}|{columns}".encode()
+    return hashlib.md5(tokenizer_bytes + settings).hexdigest()
+
+def save_splits_atomic(splits, path):
+    # Write every split under one temporary directory and rename it in a single step,
+    # so no run ever sees a cache with only some of the splits
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    for split_name, data in splits.items():
+        data.save_to_disk(os.path.join(tmp_path, split_name))
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another writer already published this cache; keep theirs
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
 def create_dataloaders(
     model_config,
     training_config,
@@ -129,27 +272,9 @@ def create_dataloaders(
     dataset_config=None,
     subset_size=None,
     val_split_fraction=0.1,
-    seed=42
+    seed=42,
+    cache_dir='./data/cache'
 ):
-    if rank == 0: # Only rank 0 should clear cache to avoid race conditions in DDP
-        print("Checking Hugging Face cache directory...")
-        hf_cache_home = os.environ.get("HF_HOME", os.path.expanduser("~/.cache/huggingface"))
-        datasets_cache_path = os.path.join(hf_cache_home, "datasets")
-        multi30k_cache_path = os.path.join(datasets_cache_path, "bentrevett___multi30k")
-
-        if os.path.exists(multi30k_cache_path):
-            print(f"Found existing Multi30k cache at: {multi30k_cache_path}")
-            print("Deleting Multi30k cache to force fresh download...")
-            import shutil
-            try:
-                shutil.rmtree(multi30k_cache_path)
-                print("Multi30k cache deleted successfully.")
-            except Exception as e:
-                print(f"Error deleting cache: {e}")
-                print("You might need to manually inspect/delete if permissions are an issue.")
-        else:
-            print("Multi30k cache not found or already cleared.")
-    
     tokenizer_path = os.path.join(os.path.dirname(__file__), '..', 'en-de-tokenizer.json')
     if not os.path.exists(tokenizer_path):
         raise FileNotFoundError(f"Tokenizer not found at {tokenizer_path}. Run tokenizer script first.")
@@ -167,41 +292,72 @@ def create_dataloaders(
     if tokenizer.eos_token_id is None:
         tokenizer.eos_token_id = 2  # Common EOS token ID
     
-    # Set the token strings if they're missing
+    # Set the token strings if they're missing, using the Rust vocab lookup when available
+    backend = getattr(tokenizer, '_tokenizer', None)
+    if backend is not None:
+        id_to_token = backend.id_to_token
+    else:
+        id_to_token = lambda token_id: tokenizer.convert_ids_to_tokens([token_id])[0]
     if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.convert_ids_to_tokens([tokenizer.pad_token_id])[0]
+        tokenizer.pad_token = id_to_token(tokenizer.pad_token_id)
     if tokenizer.bos_token is None:
-        tokenizer.bos_token = tokenizer.convert_ids_to_tokens([tokenizer.bos_token_id])[0]
+        tokenizer.bos_token = id_to_token(tokenizer.bos_token_id)
     if tokenizer.eos_token is None:
-        tokenizer.eos_token = tokenizer.convert_ids_to_tokens([tokenizer.eos_token_id])[0]
+        tokenizer.eos_token = id_to_token(tokenizer.eos_token_id)
     
     pad_id = tokenizer.pad_token_id    
 
-    try:
-        if rank == 0:
-            print(f"Loading '{dataset_name}' dataset...")
-        train_data = load_dataset(dataset_name, name=None, split='train')
-        val_data = load_dataset(dataset_name, name=None, split='validation')
+    cache_key = tokenized_cache_key(tokenizer_path, dataset_name, model_config.max_seq_len, subset_size, seed)
+    cache_path = os.path.join(cache_dir, f"tok_{cache_key}")
+    cache_exists = os.path.exists(cache_path)
+    cache_hit = cache_exists
+    if dist.is_available() and dist.is_initialized():
+        # The miss branch runs collectives, so every rank must take the same branch:
+        # only use the cache when it is present on all ranks (e.g. not on every node)
+        flags = [None] * dist.get_world_size()
+        dist.all_gather_object(flags, cache_exists)
+        cache_hit = all(flags)
 
-        # NOW call the leakage check function AFTER data is loaded
-        if rank == 0:
-            val_data_list = check_and_remove_leakage(train_data, val_data, rank)
+    try:
+        if cache_hit:
+            if rank == 0:
+                print(f"Loading tokenized '{dataset_name}' from cache: {cache_path}")
+            train_data = load_from_disk(os.path.join(cache_path, 'train'))
+            val_data = load_from_disk(os.path.join(cache_path, 'validation'))
         else:
-            val_data_list = list(val_data)
+            if rank == 0:
+                print(f"Loading '{dataset_name}' dataset...")
+            train_data, val_data = load_dataset(dataset_name, split=['train', 'validation'])
+
+            # NOW call the leakage check function AFTER data is loaded
+            val_data = check_and_remove_leakage(train_data, val_data, rank)
+
+            if subset_size is not None and subset_size < len(train_data):
+                if rank == 0:
+                    print(f"Using a subset of {subset_size} training samples.")
+                train_data = train_data.shuffle(seed=seed + 1).select(range(subset_size))
 
-        if subset_size is not None and subset_size < len(train_data):
             if rank == 0:
-                print(f"Using a subset of {subset_size} training samples.")
-            train_data = train_data.shuffle(seed=seed + 1).select(range(subset_size))
+                print("Tokenizing datasets...")
 
-        if rank == 0:
-            print(f"Using {len(train_data):,} samples for training and {len(val_data_list):,} for validation.")
+            # Large corpora can shard tokenization over processes; Multi30k is fastest in one
+            train_data = tokenize_dataset(
+                train_data, tokenizer, model_config.max_seq_len, num_proc=training_config.tokenize_num_proc
+            )
+            val_data = tokenize_dataset(val_data, tokenizer, model_config.max_seq_len)
+
+            if not cache_exists:
+                # Ranks sharing a filesystem race here; save_splits_atomic keeps the first writer
+                os.makedirs(cache_dir, exist_ok=True)
+                save_splits_atomic({'train': train_data, 'validation': val_data}, cache_path)
+                if rank == 0:
+                    print(f"Saved tokenized datasets to cache: {cache_path}")
 
-        train_data_list = list(train_data)
-        # val_data_list is already set above
+        if rank == 0:
+            print(f"Using {len(train_data):,} samples for training and {len(val_data):,} for validation.")
 
-        train_dataset = TranslationDataset(train_data_list, tokenizer, model_config.max_seq_len)
-        val_dataset = TranslationDataset(val_data_list, tokenizer, model_config.max_seq_len)
+        train_dataset = TranslationDataset(train_data)
+        val_dataset = TranslationDataset(val_data)
 
         collate_with_pad = partial(collate_fn, pad_token_id=pad_id)
 
@@ -211,25 +367,36 @@ def create_dataloaders(
         import sys
         sys.exit(1)
             
+    src_lengths = train_data.with_format('numpy')['src_len'][:]
+    train_batch_sampler = BucketBatchSampler(
+        src_lengths,
+        training_config.batch_size,
+        shuffle=True,
+        num_replicas=world_size if use_ddp else 1,
+        rank=rank if use_ddp else 0,
+        seed=seed
+    )
+
     if use_ddp:
-        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
         val_sampler = DistributedSampler(val_dataset, num_replicas=world_size, rank=rank, shuffle=False)
-        train_shuffle = False
     else:
-        train_sampler = None
         val_sampler = None
-        train_shuffle = True
 
     num_workers = getattr(training_config, 'num_workers', 2)
 
+    # Pinning targets the current CUDA device, which train_ddp.py sets for each process
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': True}
+    if num_workers > 0:
+        # Keep workers alive across epochs instead of re-forking them every epoch
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = training_config.prefetch_factor
+        loader_kwargs['worker_init_fn'] = partial(pin_worker_to_core, rank=rank, num_workers=num_workers)
+
     train_loader = DataLoader(
         train_dataset, 
-        batch_size=training_config.batch_size, 
+        batch_sampler=train_batch_sampler,
         collate_fn=collate_with_pad,
-        sampler=train_sampler,
-        shuffle=train_shuffle,
-        num_workers=num_workers, 
-        pin_memory=True
+        **loader_kwargs
     )
     
     val_loader = DataLoader(
@@ -238,8 +405,11 @@ def create_dataloaders(
         collate_fn=collate_with_pad,
         sampler=val_sampler,
         shuffle=False, 
-        num_workers=num_workers,
-        pin_memory=True
+        **loader_kwargs
     )
+
+    if torch.cuda.is_available():
+        train_loader = CUDAPrefetcher(train_loader)
+        val_loader = CUDAPrefetcher(val_loader)
     
     return train_loader, val_loader, tokenizer
\ No newline at end of file
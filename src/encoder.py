@@ -1,38 +1,73 @@
 import torch.nn as nn
+import torch.nn.functional as F
 from .attention import MultiHeadAttention
 import torch
+
+try:
+    # Single-kernel LayerNorm; same parameters as nn.LayerNorm so checkpoints stay compatible
+    from apex.normalization import FusedLayerNorm as LayerNorm
+except ImportError:
+    LayerNorm = nn.LayerNorm
+
 class EncoderLayer(nn.Module):
-    def __init__(self, d_model, n_heads, d_ff, dropout=0.1):
+    def __init__(self, d_model, n_heads, d_ff, dropout=0.1, ffn_bf16=False):
         super().__init__()
         self.self_attention = MultiHeadAttention(d_model, n_heads, dropout=dropout)
-        self.feed_forward = nn.Sequential(nn.Linear(d_model, d_ff), nn.GELU(), nn.Dropout(dropout), nn.Linear(d_ff, d_model))
-        self.norm1 = nn.LayerNorm(d_model, eps=1e-6) 
-        self.norm2 = nn.LayerNorm(d_model, eps=1e-6)
-        self.dropout = nn.Dropout(dropout)
+        self.linear1 = nn.Linear(d_model, d_ff)
+        self.linear2 = nn.Linear(d_ff, d_model)
+        self.norm1 = LayerNorm(d_model, eps=1e-6) 
+        self.norm2 = LayerNorm(d_model, eps=1e-6)
+        self.p = dropout
+        self.ffn_bf16 = ffn_bf16
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints store the FFN as an nn.Sequential under feed_forward.{0,3}
+        for old, new in (('feed_forward.0.', 'linear1.'), ('feed_forward.3.', 'linear2.')):
+            for key in [k for k in state_dict if k.startswith(prefix + old)]:
+                state_dict[prefix + new + key[len(prefix + old):]] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def feed_forward(self, x):
+        return self.linear2(F.dropout(F.gelu(self.linear1(x)), self.p, self.training))
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, cu_seqlens=None, max_seqlen=None):
         norm_x = self.norm1(x)
-        attn_output = self.self_attention(norm_x, norm_x, norm_x, mask)
-        x = x + self.dropout(attn_output)
-        # Check after first residual
-        if torch.isnan(x).any() or torch.isinf(x).any():
+        if cu_seqlens is not None:
+            attn_output = self.self_attention.forward_varlen(norm_x, cu_seqlens, max_seqlen)
+        else:
+            attn_output = self.self_attention(norm_x, norm_x, norm_x, mask)
+        x = x + F.dropout(attn_output, self.p, self.training)
+        # Check after first residual; skipped under torch.compile, where this
+        # data-dependent branch would split the graph and block the residual + LayerNorm fusion
+        if not torch.compiler.is_compiling() and (torch.isnan(x).any() or torch.isinf(x).any()):
             raise ValueError("NaN/Inf after first residual in EncoderLayer")
 
         norm_x = self.norm2(x)
-        ff_output = self.feed_forward(norm_x)
-        x = x + self.dropout(ff_output)
-        # Check after second residual
-        if torch.isnan(x).any() or torch.isinf(x).any():
+        if self.ffn_bf16 and x.is_cuda and not torch.is_autocast_enabled():
+            # Run the FFN matmuls on BF16 tensor cores; norms and residuals stay in fp32
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+                ff_output = self.feed_forward(norm_x)
+        else:
+            ff_output = self.feed_forward(norm_x)
+        x = x + F.dropout(ff_output, self.p, self.training)
+        # Check after second residual (eager only, as above)
+        if not torch.compiler.is_compiling() and (torch.isnan(x).any() or torch.isinf(x).any()):
             raise ValueError("NaN/Inf after second residual in EncoderLayer")
         return x
 
 class Encoder(nn.Module):
-    def __init__(self, n_layers, d_model, n_heads, d_ff, dropout=0.1):
+    def __init__(self, n_layers, d_model, n_heads, d_ff, dropout=0.1, compile_encoder=False, ffn_bf16=False):
         super().__init__()
-        self.layers = nn.ModuleList([EncoderLayer(d_model, n_heads, d_ff, dropout) for _ in range(n_layers)])
+        self.layers = nn.ModuleList([EncoderLayer(d_model, n_heads, d_ff, dropout, ffn_bf16) for _ in range(n_layers)])
+        if compile_encoder:
+            # Compiling the whole stack lets Dynamo unroll the layer loop into one graph
+            # (the NaN/Inf guards are skipped while compiling) and Inductor fuse dropout +
+            # residual add + LayerNorm. Compiling in place keeps the state_dict keys
+            # identical to the eager model.
+            self.compile(dynamic=True)
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, cu_seqlens=None, max_seqlen=None):
         for layer in self.layers:
-            x = layer(x, mask)
+            x = layer(x, mask, cu_seqlens, max_seqlen)
         return x
 
@@ -164,7 +164,7 @@ class EvaluationMetrics:
                     tgt = batch['tgt'].to(device)
 
                     tgt_input = tgt[:, :-1]
-                    tgt_output = tgt[:, 1:]
+                    tgt_output = tgt[:, 1:].long()
 
                     output = model(src, tgt_input)
                     loss = criterion(output.reshape(-1, output.size(-1)), tgt_output.reshape(-1))
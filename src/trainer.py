@@ -44,6 +44,7 @@ class Trainer:
         # self.scaler = GradScaler() # COMMENTED OUT: Disabling mixed precision
         self.evaluator = EvaluationMetrics(tokenizer)
         self.global_step = 0
+        self.current_epoch = 0
         
         # Early stopping parameters
         self.best_perplexity = float('inf')
@@ -109,6 +110,7 @@ class Trainer:
     # Replace your train_epoch loss calculation section with this:
     def train_epoch(self, train_loader):
         self.model.train()
+        train_loader.batch_sampler.set_epoch(self.current_epoch)
         total_loss = 0
         accumulation_steps = self.config.accumulation_steps
         self.optimizer.zero_grad()
@@ -117,7 +119,8 @@ class Trainer:
         for batch_idx, batch in enumerate(tqdm(train_loader, desc="Training Epoch")):
             try:
                 src, tgt = batch['src'].to(self.device), batch['tgt'].to(self.device)
-                tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:]
+                # Batches hold int32 ids; the loss needs int64 targets
+                tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:].long()
 
                 # Forward pass
                 output = self.model(src, tgt_input)
@@ -268,6 +271,7 @@ class Trainer:
         print("Starting training...")
         
         for epoch in range(self.config.num_epochs):
+            self.current_epoch = epoch
             print(f"\n{'='*60}")
             print(f"EPOCH {epoch+1}/{self.config.num_epochs}")
             print(f"{'='*60}")
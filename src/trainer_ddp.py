@@ -43,7 +43,7 @@ class Trainer:
 
     def train_epoch(self, train_loader):
         self.model.train()
-        train_loader.sampler.set_epoch(self.current_epoch)
+        train_loader.batch_sampler.set_epoch(self.current_epoch)
         
         total_loss = 0
         accumulation_steps = self.config.accumulation_steps
@@ -52,7 +52,8 @@ class Trainer:
         for batch_idx, batch in enumerate(train_loader):
             src = batch['src'].to(self.device)
             tgt = batch['tgt'].to(self.device)
-            tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:]
+            # Batches hold int32 ids; the loss needs int64 targets
+            tgt_input, tgt_output = tgt[:, :-1], tgt[:, 1:].long()
 
             with autocast(device_type='cuda', dtype=torch.float16):
                 output = self.model(src, tgt_input)
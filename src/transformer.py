@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from .attention import flash_attn_varlen_qkvpacked_func
 from .embeddings import TokenEmbedding, PositionalEncoding 
 from .encoder import Encoder
 from .decoder import Decoder
@@ -14,7 +16,11 @@ class EnhancedTransformer(nn.Module):
         
         self.pos_encoding = PositionalEncoding(config.d_model, config.max_seq_len, dropout=config.dropout)
         
-        self.encoder = Encoder(config.n_layers, config.d_model, config.n_heads, config.d_ff, config.dropout)
+        self.encoder = Encoder(
+            config.n_layers, config.d_model, config.n_heads, config.d_ff, config.dropout,
+            compile_encoder=getattr(config, 'compile_encoder', False),
+            ffn_bf16=getattr(config, 'ffn_bf16', False)
+        )
         self.decoder = Decoder(config.n_layers, config.d_model, config.n_heads, config.d_ff, config.dropout)
 
         self.final_encoder_norm = nn.LayerNorm(config.d_model)
@@ -52,6 +58,28 @@ class EnhancedTransformer(nn.Module):
         
         return src_mask, tgt_mask
 
+    def _can_pack_encoder(self, src_emb):
+        # flash-attn only runs on CUDA in half precision
+        if flash_attn_varlen_qkvpacked_func is None or not src_emb.is_cuda:
+            return False
+        return torch.is_autocast_enabled() or src_emb.dtype in (torch.float16, torch.bfloat16)
+
+    def _encode_packed(self, src, src_emb):
+        # Drop pad positions so attention cost is sum(L_i^2) instead of B * L_max^2
+        batch_size, src_len, d_model = src_emb.shape
+        not_pad = src != self.pad_token_id
+        seqlens = not_pad.sum(dim=1, dtype=torch.int32)
+        cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+        max_seqlen = int(seqlens.max())
+        token_idx = not_pad.flatten().nonzero(as_tuple=True)[0]
+
+        packed = src_emb.reshape(-1, d_model)[token_idx]
+        packed = self.encoder(packed, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
+
+        encoder_output = packed.new_zeros(batch_size * src_len, d_model)
+        encoder_output[token_idx] = packed
+        return encoder_output.view(batch_size, src_len, d_model)
+
     def forward(self, src, tgt, src_mask=None, tgt_mask=None):
         if src_mask is None or tgt_mask is None:
             src_mask, tgt_mask = self.create_mask(src, tgt)
@@ -68,7 +96,10 @@ class EnhancedTransformer(nn.Module):
         if torch.isnan(src_emb).any():
             print("NaN in source embeddings!")
         
-        encoder_output = self.encoder(src_emb, src_mask)
+        if self._can_pack_encoder(src_emb):
+            encoder_output = self._encode_packed(src, src_emb)
+        else:
+            encoder_output = self.encoder(src_emb, src_mask)
         
         # Check encoder output
         if torch.isnan(encoder_output).any():
@@ -0,0 +1,42 @@
+from tokenizers import Tokenizer
+from tokenizers.models import BPE
+from tokenizers.pre_tokenizers import Whitespace
+from tokenizers.trainers import BpeTrainer
+from transformers import PreTrainedTokenizerFast
+
+from src.dataset import tokenize_batch
+
+
+def make_padded_tokenizer():
+    # Same setup as src/train_tokenizer.py, including the padding saved into the file
+    tokenizer = Tokenizer(BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    trainer = BpeTrainer(special_tokens=["<unk>", "<s>", "</s>", "<pad>"])
+    tokenizer.train_from_iterator(["hello world this is a test", "hallo welt das ist ein test"] * 10, trainer=trainer)
+    tokenizer.enable_padding(pad_id=tokenizer.token_to_id("<pad>"), pad_token="<pad>")
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>"
+    )
+
+
+def test_tokenize_batch_ignores_backend_padding():
+    tokenizer = make_padded_tokenizer()
+    batch = {'translation': [
+        {'en': 'hello', 'de': 'hallo'},
+        {'en': 'hello world this is a test', 'de': 'hallo welt das ist ein test'}
+    ]}
+
+    out = tokenize_batch(batch, tokenizer, max_length=32)
+
+    bos, eos = tokenizer.bos_token_id, tokenizer.eos_token_id
+    for i, pair in enumerate(batch['translation']):
+        src = tokenizer.encode(pair['en'], add_special_tokens=False, padding=False)
+        tgt = tokenizer.encode(pair['de'], add_special_tokens=False, padding=False)
+        assert out['src_ids'][i] == [bos] + src + [eos]
+        assert out['tgt_ids'][i] == [bos] + tgt + [eos]
+        assert out['src_len'][i] == len(out['src_ids'][i])
+        assert out['tgt_len'][i] == len(out['tgt_ids'][i])
+    assert out['src_len'][0] < out['src_len'][1]
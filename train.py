@@ -226,6 +226,8 @@ def get_args():
                        help='Disable torch.compile for compatibility.')
     parser.add_argument('--mixed_precision', action='store_true', default=True,
                        help='Use mixed precision training.')
+    parser.add_argument('--ffn_bf16', action='store_true',
+                       help='Run the encoder feed-forward layers in BF16 (needs a BF16-capable GPU).')
     
     # Testing and debugging
     parser.add_argument('--dry_run', action='store_true', 
@@ -420,6 +422,8 @@ def main():
     model_config.d_model = args.d_model
     model_config.n_heads = args.num_heads
     model_config.dropout = args.dropout
+    model_config.compile_encoder = training_config.compile_model and not args.no_compile
+    model_config.ffn_bf16 = args.ffn_bf16 and training_config.mixed_precision
     
     # Save configuration
     config_path = save_config(args, model_config, training_config, args.save_dir)